@@ -3,7 +3,9 @@
 import os
 import random
 import sys
+from collections import Counter, OrderedDict
 from enum import Enum
+from typing import Callable, NamedTuple
 
 import chess
 import stockfish
@@ -26,6 +28,8 @@ STOCKFISH_SETTINGS = {
     "UCI_LimitStrength": "true",  # "false",
     "UCI_Elo": 1350,
 }
+ANALYSIS_DEPTH = 20
+EVAL_CACHE_SIZE = 1024
 START_POSITION = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
 SPLASH_MESSAGE = r"""
  ____  __    __  __ _  ____     ___  _  _  ____  ____  ____
@@ -55,11 +59,46 @@ class GameState(Enum):
     CHECKMATE = "checkmate"
     STALEMATE = "draw: stalemate"
     REPETITION = "draw: repetition"
+    INSUFFICIENT_MATERIAL = "draw: insufficient material"
+    SEVENTYFIVE_MOVES = "draw: seventy-five-move rule"
     RESIGNED = "resigned"
 
 
+TERMINATION_STATES = {
+    chess.Termination.CHECKMATE: GameState.CHECKMATE,
+    chess.Termination.STALEMATE: GameState.STALEMATE,
+    chess.Termination.INSUFFICIENT_MATERIAL: GameState.INSUFFICIENT_MATERIAL,
+    chess.Termination.SEVENTYFIVE_MOVES: GameState.SEVENTYFIVE_MOVES,
+    chess.Termination.FIVEFOLD_REPETITION: GameState.REPETITION,
+}
+
+
+class FenFields(NamedTuple):
+    """The fields of a FEN string"""
+
+    pieces: str
+    turn: str
+    castling: str
+    en_passant: str
+    halfmove: int
+    fullmove: int
+
+
+def _parse_fen(fen: str) -> FenFields:
+    """Split a FEN string into its fields, defaulting missing ones like python-chess"""
+    fields = fen.split()
+    fields += ["", "w", "-", "-", "0", "1"][len(fields) :]
+    pieces, turn, castling, en_passant, halfmove, fullmove = fields[:6]
+    return FenFields(pieces, turn, castling, en_passant, int(halfmove), int(fullmove))
+
+
+def _position_id(fen: str) -> str:
+    """Return the pieces, turn, castling and en passant fields of a FEN string"""
+    return " ".join(fen.split(" ", 4)[:4])
+
+
 class StockfishMod(stockfish.Stockfish):
-    """Modified Stockfish class, make the destructor more robust"""
+    """Modified Stockfish class, with a more robust destructor and pondering"""
 
     def __del__(self):
         """Catch attribute errors thrown during cleanup"""
@@ -68,27 +107,105 @@ class StockfishMod(stockfish.Stockfish):
         except AttributeError:
             pass
 
+    def _put_lines(self, *commands: str) -> None:
+        """Send several commands to Stockfish in a single write"""
+        if not self._stockfish.stdin:
+            raise BrokenPipeError()
+        # Same guard as _put, a dead engine is then reported when reading the reply
+        if self._stockfish.poll() is None and not self._has_quit_command_been_sent:
+            self._stockfish.stdin.write("".join(f"{command}\n" for command in commands))
+            self._stockfish.stdin.flush()
+
+    @staticmethod
+    def _position_command(fen_position: str, moves: list[str]) -> str:
+        """Return the UCI command for the position after the moves"""
+        if not moves:
+            return f"position fen {fen_position}"
+        return f"position fen {fen_position} moves {' '.join(moves)}"
+
+    def search_position(
+        self, fen_position: str, moves: list[str]
+    ) -> tuple[str | None, str | None]:
+        """Search the position after the moves, return the best move and the reply"""
+        self._put_lines(
+            self._position_command(fen_position, moves), f"go depth {self.depth}"
+        )
+        return self.read_best_and_ponder_move()
+
+    def read_best_and_ponder_move(self) -> tuple[str | None, str | None]:
+        """Wait for an ongoing search to finish and return its "bestmove" line"""
+        while True:
+            splitted_text = self._read_line().split(" ")
+            if splitted_text[0] == "bestmove":
+                best_move = None if splitted_text[1] == "(none)" else splitted_text[1]
+                if len(splitted_text) > 3 and splitted_text[2] == "ponder":
+                    return best_move, splitted_text[3]
+                return best_move, None
+
+    def start_pondering(self, fen_position: str, moves: list[str]) -> None:
+        """Search the position after the moves, ending with the expected reply"""
+        # The depth limit keeps the output bounded however long the wait is
+        self._put_lines(
+            self._position_command(fen_position, moves),
+            f"go ponder depth {self.depth}",
+        )
+
+    def ponderhit(self) -> None:
+        """The expected reply was played, turn the ponder search into a real one"""
+        self._put("ponderhit")
+
+    def stop_pondering(self) -> None:
+        """Abort the ponder search and discard its result"""
+        self._put("stop")
+        self.read_best_and_ponder_move()
+
+
 class Analyzer:  # pylint: disable=too-few-public-methods
     """Stockfish analyzer for evaluation of positions"""
 
     class StockfishError(Exception):
         """Raise when there are issues with Stockfish"""
 
-    def __init__(self) -> None:
-        try:
-            self.stockfish = StockfishMod(STOCKFISH_PATH)
-        except (AttributeError, FileNotFoundError):
-            print("Could not find Stockfish. Exiting...")
-            sys.exit(1)
-        self.stockfish.set_elo_rating(3500)
+    def __init__(
+        self,
+        engine: StockfishMod,
+        set_position: Callable[[str], None] | None = None,
+    ) -> None:
+        self.stockfish = engine
+        self._set_position = set_position or self._set_fen
+        self._eval_cache: OrderedDict[str, str] = OrderedDict()
 
     def get_evaluation(self, fen_position: str) -> str:
-        """Return the evaluation for the current position"""
-        self.stockfish.set_fen_position(fen_position)
-        evaluation = self.stockfish.get_evaluation()
+        """Return the evaluation for the current position, cached per position"""
+        # The move clocks don't matter for the evaluation, leave them out of the key
+        key = _position_id(fen_position)
+        if key in self._eval_cache:
+            self._eval_cache.move_to_end(key)
+            return self._eval_cache[key]
+        evaluation = self._evaluate(fen_position)
+        self._eval_cache[key] = evaluation
+        if len(self._eval_cache) > EVAL_CACHE_SIZE:
+            self._eval_cache.popitem(last=False)
+        return evaluation
+
+    def _set_fen(self, fen_position: str) -> None:
+        """Set the position of the engine"""
+        # All positions come from the same game, so keep the hash table
+        self.stockfish.set_fen_position(fen_position, send_ucinewgame_token=False)
+
+    def _evaluate(self, fen_position: str) -> str:
+        """Let Stockfish evaluate the position"""
+        self._set_position(fen_position)
+        # Search deeper than when playing, the strength settings only affect move choice
+        play_depth = self.stockfish.depth
+        self.stockfish.set_depth(ANALYSIS_DEPTH)
+        try:
+            evaluation = self.stockfish.get_evaluation()
+        finally:
+            self.stockfish.set_depth(play_depth)
         if evaluation["type"] == "cp":
             # centipawns:
-            return evaluation["value"] / 100
+            return f"{evaluation['value'] / 100:+.2f}"
         if evaluation["type"] == "mate":
             return f"""mate {evaluation["value"]}"""
         return "? " + str(evaluation)
@@ -105,27 +222,102 @@ class Game:
             self.start_positions = start_pos
         else:
             self.start_positions = START_POSITION
-        self.board = chess.Board(start_pos)
-        self.stockfish = StockfishMod(STOCKFISH_PATH, parameters=STOCKFISH_SETTINGS)
-        self.analyzer = Analyzer()
-        self.stockfish.set_fen_position(self.board.fen())
-        self.move_counter = int(start_pos.split(" ")[-1])
+        self.board = chess.Board(self.start_positions)
+        try:
+            self.stockfish = StockfishMod(STOCKFISH_PATH, parameters=STOCKFISH_SETTINGS)
+        except (AttributeError, FileNotFoundError):
+            print("Could not find Stockfish. Exiting...")
+            sys.exit(1)
+        # The analyzer shares the playing engine, and only uses it on a cache miss
+        self.analyzer = Analyzer(self.stockfish, set_position=self._sync_engine)
+        self._fen_cache: tuple[int, str] | None = None
+        self.stockfish.set_fen_position(self._current_fen())
+        self._engine_fen: str | None = self._current_fen()
+        self._ponder_move: str | None = None
+        self._uci_history: list[str] = []
+        self._pgn_parts: list[str] = []
+        # Occurrences of the positions since the last irreversible move
+        self._position_counts: Counter[str] = Counter([self._position_id()])
+        self.move_counter = _parse_fen(self.start_positions).fullmove
         self.game_state: GameState = GameState.ONGOING
         self.latest_command: str = ""
         self.opponents_turn: bool = False
+        self._commands = {
+            alias: handler
+            for aliases, handler in (
+                (("h", "help"), self._cmd_help),
+                (("i", "info"), self._cmd_info),
+                (("b", "board"), self.show_board),
+                (("q", "quit", "exit"), self._cmd_quit),
+            )
+            for alias in aliases
+        }
+
+    def _current_fen(self) -> str:
+        """Return the FEN of the current position, generated once per ply"""
+        ply = len(self.board.move_stack)
+        if self._fen_cache is None or self._fen_cache[0] != ply:
+            self._fen_cache = (ply, self.board.fen())
+        return self._fen_cache[1]
+
+    def _push_move(self, move: chess.Move) -> str:
+        """Play a move, update the position bookkeeping and return the move as SAN"""
+        ply = len(self.board.move_stack)
+        if not ply & 1:
+            self._pgn_parts.append(f"{(ply >> 1) + 1}. ")
+        san = self.board.san(move)
+        self._pgn_parts.append(f"{san} ")
+        if self.board.is_irreversible(move):
+            self._position_counts.clear()
+        self.board.push(move)
+        self._uci_history.append(move.uci())
+        self._fen_cache = None
+        self._position_counts[self._position_id()] += 1
+        return san
+
+    def _position_id(self) -> str:
+        """Return the current position without the move clocks"""
+        return _position_id(self._current_fen())
+
+    def _sync_engine(self, fen: str) -> None:
+        """Set the position of the playing engine, unless it is already there"""
+        self._stop_pondering()
+        if fen == self._engine_fen:
+            return
+        # Skip "ucinewgame" since it clears the engine's hash table
+        self.stockfish.set_fen_position(fen, send_ucinewgame_token=False)
+        self._engine_fen = fen
+
+    def _start_pondering(self, ponder_move: str) -> None:
+        """Let the engine think on the expected reply during the human's turn"""
+        self.stockfish.start_pondering(
+            self.start_positions, self._uci_history + [ponder_move]
+        )
+        self._ponder_move = ponder_move
+        self._engine_fen = None
+
+    def _stop_pondering(self) -> None:
+        """Stop any ongoing ponder search so that the engine can take commands"""
+        if self._ponder_move is None:
+            return
+        self.stockfish.stop_pondering()
+        self._ponder_move = None
+
+    def _get_best_move(self) -> tuple[str | None, str | None]:
+        """Return Stockfish's move and its expected reply, reusing a ponder hit"""
+        if self._ponder_move and self._ponder_move == self.board.peek().uci():
+            self.stockfish.ponderhit()
+            self._ponder_move = None
+            self._engine_fen = self._current_fen()
+            return self.stockfish.read_best_and_ponder_move()
+        self._stop_pondering()
+        self._engine_fen = self._current_fen()
+        # Send the whole game, so that Stockfish knows about repetitions
+        return self.stockfish.search_position(self.start_positions, self._uci_history)
 
     def get_game_as_pgn(self) -> str:
         """Create a PGN string from the current game"""
-        temp_board = chess.Board(self.start_positions)
-        move_count = 1
-        out = ""
-        for move_no, move in enumerate(self.board.move_stack, start=1):
-            if move_no % 2:
-                out += f"{move_count}. "
-                move_count += 1
-            out += temp_board.san(move) + " "
-            temp_board.push(move)
-        return out
+        return "".join(self._pgn_parts)
 
     def get_welcome_message(self) -> str:
         """Return Stockfish version and settings"""
@@ -135,46 +327,42 @@ class Game:
             f' with elo {self.stockfish.get_parameters()["UCI_Elo"]}'
         )
 
-    def update_game_state(self) -> str:
+    def update_game_state(self) -> None:
         """Check game state and update the class variable"""
-        if self.board.is_checkmate():
-            self.game_state = GameState.CHECKMATE
-        elif self.board.is_stalemate():
-            self.game_state = GameState.STALEMATE
-        elif self.board.is_repetition():
+        # Covers all automatic endings, but not threefold repetition
+        outcome = self.board.outcome()
+        if outcome is not None:
+            self.game_state = TERMINATION_STATES[outcome.termination]
+        elif self._position_counts[self._position_id()] >= 3:
             self.game_state = GameState.REPETITION
         else:
             self.game_state = GameState.ONGOING
 
     def do_command(self, command: str) -> bool:
         """Execute a user command. Returns False if it was a move, True otherwise"""
-        # Help
-        if command.lower() in ["h", "help"]:
-            print(HELP_MESSAGE)
-            return True
-
-        # Info
-        if command.lower() in ["i", "info"]:
-            if self.board.is_check():
-                print("     In check!")
-            print(
-                "     Allowed to castle:",
-                "yes" if self.board.has_castling_rights(chess.WHITE) else "no",
-            )
-            print("     Evaluation:", self.analyzer.get_evaluation(self.board.fen()))
-            return True
-
-        # Show?
-        if command.lower() in ["b", "board"]:
-            self.show_board()
-            return True
+        handler = self._commands.get(command.lower())
+        if handler is None:
+            return False
+        handler()
+        return True
 
-        # Quit?
-        if command.lower() in ["q", "quit", "exit"]:
-            self.game_state = GameState.RESIGNED
-            return True
+    def _cmd_help(self) -> None:
+        """Show the help message"""
+        print(HELP_MESSAGE)
+
+    def _cmd_info(self) -> None:
+        """Show information about the current position"""
+        if self.board.is_check():
+            print("     In check!")
+        print(
+            "     Allowed to castle:",
+            "yes" if self.board.has_castling_rights(chess.WHITE) else "no",
+        )
+        print("     Evaluation:", self.analyzer.get_evaluation(self._current_fen()))
 
-        return False
+    def _cmd_quit(self) -> None:
+        """Resign the game"""
+        self.game_state = GameState.RESIGNED
 
     def do_human_move(self) -> bool:
         """Get input from the human player"""
@@ -185,24 +373,24 @@ class Game:
             return
 
         self.opponents_turn = False
+        # Commands are checked first, so they don't have to fail as moves
+        if self.do_command(command):
+            return self.opponents_turn
         try:
             human_move = self.board.parse_san(command)
-            self.board.push(human_move)
-            self.opponents_turn = True
         except (chess.IllegalMoveError, chess.InvalidMoveError) as exc:
-            result = self.do_command(command)
-            if not result:
-                print(f"😨 {self.CommandError(exc)}")
-        if not self.game_state == GameState.RESIGNED:
-            self.update_game_state()
-        
+            print(f"😨 {self.CommandError(exc)}")
+            return self.opponents_turn
+        self._push_move(human_move)
+        self.opponents_turn = True
+        self.update_game_state()
+
         return self.opponents_turn
 
     def do_stockfish_move(self) -> bool:
         """Let Stockfish do a move"""
         print(f"{self.move_counter}. Hmm....  ", end="", flush=True)
-        self.stockfish.set_fen_position(self.board.fen())
-        ai_move_uci = self.stockfish.get_best_move()
+        ai_move_uci, ponder_move_uci = self._get_best_move()
         # ai_move_uci = STOCKFISH.get_top_moves(5)[-1]
         ai_move = self.board.parse_uci(ai_move_uci)
         try:
@@ -214,17 +402,18 @@ class Game:
             response = "? " + ai_move_uci
         opponent_move = ai_move
 
-        response = self.board.san(opponent_move)
+        response = self._push_move(opponent_move)
         print("    My move:", response)
-        self.board.push(opponent_move)
         self.update_game_state()
         self.opponents_turn = True
+        if ponder_move_uci and self.game_state is GameState.ONGOING:
+            self._start_pondering(ponder_move_uci)
 
         return True
 
     def show_board(self):
         """Draw the board with ASCII characters"""
-        self.stockfish.set_fen_position(self.board.fen())
+        self._sync_engine(self._current_fen())
         print(self.stockfish.get_board_visual())
 
 
@@ -236,6 +425,12 @@ def main(*, start_positions=None):
     print("Would you prefer to play as white, black or random?")
     side = input("Enter b, w or r: ")
     print()
+    if side.lower() in ("r", "random"):
+        side = random.choice(("black", "white"))
+    # Check the side before Stockfish is started
+    if side.lower() not in ("b", "black", "w", "white"):
+        print(f"Illegal side, has to be one of r, b, or w! You entered {side}")
+        sys.exit(1)
     print("What elo rating would you prefer Stockfish to have?")
     elo = input("Enter the elo number or press enter for default (1350): ")
     print()
@@ -258,18 +453,12 @@ def main(*, start_positions=None):
     # MAIN LOOP
     #
 
-    if side.lower() in ("r", "random"):
-        side = random.choice(("black", "white"))
-
     if side.lower() in ("b", "black"):
         print("You play black!")
         order = (game.do_stockfish_move, game.do_human_move)
-    elif side.lower() in ("w", "white"):
+    else:
         print("You play white!")
         order = (game.do_human_move, game.do_stockfish_move)
-    else:
-        print(f"Illegal side, has to be one of r, b, or w! You entered {side}")
-        sys.exit(1)
 
     game.opponents_turn = True
     should_continue = True
@@ -296,14 +485,14 @@ def main(*, start_positions=None):
     #
     # Print board:
     try:
-        print(game.stockfish.get_board_visual())
+        game.show_board()
     except stockfish.models.StockfishException as _exc:
         print(f"Could not draw the board due to a Stockfish error: {_exc}")
     # Print FEN:
     print("----- FEN: -----")
     print(game.board.fen())
     # Print PGN:
-    if start_positions.split(" ")[-1] == "1":
+    if _parse_fen(start_positions).fullmove == 1:
         print("----- PGN: -----")
         print(game.get_game_as_pgn())
     print("----------------")